@@ -1,4 +1,5 @@
-import json
+import orjson
+import os
 from pathlib import Path
 from typing import List, Dict
 
@@ -7,17 +8,19 @@ CONFIG_DIR.mkdir(exist_ok=True)
 MONITORED_STOPS_FILE = CONFIG_DIR / "monitored_stops.json"
 
 def save_monitored_stops(stops: List[Dict]) -> None:
-    """Save the list of monitored stops to a config file"""
-    with open(MONITORED_STOPS_FILE, 'w') as f:
-        json.dump(stops, f, indent=2)
+    """Save the list of monitored stops to a config file atomically"""
+    # Write to a sibling temp file and rename into place so a crash
+    # mid-write can never leave a truncated config behind
+    tmp_file = MONITORED_STOPS_FILE.with_suffix('.tmp')
+    with open(tmp_file, 'wb') as f:
+        f.write(orjson.dumps(stops, option=orjson.OPT_INDENT_2))
+    os.replace(tmp_file, MONITORED_STOPS_FILE)
 
 def load_monitored_stops() -> List[Dict]:
     """Load the list of monitored stops from the config file"""
-    if not MONITORED_STOPS_FILE.exists():
-        return []
-    
     try:
-        with open(MONITORED_STOPS_FILE, 'r') as f:
-            return json.load(f)
-    except:
-        return [] 
\ No newline at end of file
+        return orjson.loads(MONITORED_STOPS_FILE.read_bytes())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        # A truncated file left by the old non-atomic writer reads the
+        # same as a missing one: start with an empty list
+        return []
\ No newline at end of file
@@ -1,11 +1,24 @@
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+from pyarrow import csv as pacsv
 import urllib.request
-from io import StringIO
+from io import BytesIO
+import math
 import os
 from datetime import datetime, timedelta
 import json
 from typing import Dict, List, Optional
 from pathlib import Path
+from scipy.spatial import cKDTree
+
+# Numba is optional: the NumPy fallbacks below are fast enough on small
+# hosts where a JIT compiler isn't worth installing
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
 
 # Create cache directory if it doesn't exist
 CACHE_DIR = Path("cache")
@@ -14,24 +27,117 @@ CACHE_DIR.mkdir(exist_ok=True)
 DATA_DIR = Path("data")
 DATA_DIR.mkdir(exist_ok=True)
 
-STOPS_CACHE_FILE = CACHE_DIR / "stops.json"
+STOPS_CACHE_FILE = CACHE_DIR / "stops.feather"
+STOPS_META_FILE = CACHE_DIR / "stops.meta.json"
 STOPS_DATA_FILE = DATA_DIR / "CTA_STOP_XFERS.csv"
 CACHE_DURATION = timedelta(days=1)  # Update stops data daily
 
+# Bump when the cached frame's layout changes (columns, dtypes, codes)
+# so stale feather files from older builds get rebuilt instead of read
+CACHE_SCHEMA_VERSION = 2
+
+EARTH_RADIUS_MILES = 3959.87433
+
+# Narrow dtypes for the stops table: categorical route columns and 32-bit
+# numerics halve the bytes scanned by the per-request distance filter
+STOPS_DTYPES = {
+    'route_id': 'category',
+    'route_code': 'category',
+    'stop_name': 'string',
+    'stop_id': 'int32',
+    'stop_lat': 'float32',
+    'stop_lon': 'float32',
+    'heading_degrees': 'float32',
+}
+
+# In-process cache of (cache-file mtime, data timestamp, stops index).
+# The mtime key invalidates when the file on disk is refreshed; the
+# timestamp keeps the daily CACHE_DURATION refresh working on a
+# long-running server
+_STOPS_CACHE: Optional[tuple] = None
+
+def _build_stops_index(df: pd.DataFrame) -> Dict:
+    """Build the KDTree and stop-type masks used by get_nearby_stops"""
+    coords = np.stack([
+        np.radians(df['stop_lat'].to_numpy(dtype=np.float64)),
+        np.radians(df['stop_lon'].to_numpy(dtype=np.float64))
+    ], axis=1)
+    stop_type = df['stop_type'].to_numpy()
+    return {
+        'df': df,
+        'tree': cKDTree(coords),
+        'is_bus': stop_type == 'bus',
+        'is_parent_train': stop_type == 'parent_train',
+    }
+
+def _get_stops_index() -> Dict:
+    """Return the cached stops index, building it if the frame came from a fallback path"""
+    df = load_stops_data()
+    if _STOPS_CACHE is not None and _STOPS_CACHE[2]['df'] is df:
+        return _STOPS_CACHE[2]
+    return _build_stops_index(df)
+
+if NUMBA_AVAILABLE:
+    # Single-threaded on purpose: prange fork/join costs more than it
+    # saves at ~10k rows, and the parallel threading layer can hang
+    # interpreter shutdown when first run off the main thread
+    @njit(fastmath=True, cache=True)
+    def _haversine_kernel(lat0: float, lon0: float, lats, lons, out):
+        """Fused Haversine loop: no intermediate arrays, SIMD-friendly"""
+        lat0 = math.radians(lat0)
+        lon0 = math.radians(lon0)
+        cos_lat0 = math.cos(lat0)
+        for i in range(lats.shape[0]):
+            lat1 = math.radians(lats[i])
+            dlat = lat1 - lat0
+            dlon = math.radians(lons[i]) - lon0
+            a = math.sin(dlat*0.5)**2 + cos_lat0 * math.cos(lat1) * math.sin(dlon*0.5)**2
+            out[i] = EARTH_RADIUS_MILES * 2.0 * math.asin(math.sqrt(a))
+
+def haversine_vec(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """Haversine distance in miles from (lat, lon) to arrays of coordinates"""
+    if NUMBA_AVAILABLE:
+        out = np.empty(lats.shape[0], dtype=np.float64)
+        _haversine_kernel(lat, lon, np.ascontiguousarray(lats), np.ascontiguousarray(lons), out)
+        return out
+
+    lat0 = np.radians(lat)
+    lon0 = np.radians(lon)
+    lats = np.radians(lats)
+    lons = np.radians(lons)
+    dlat = lats - lat0
+    dlon = lons - lon0
+
+    a = np.sin(dlat/2)**2 + np.cos(lat0) * np.cos(lats) * np.sin(dlon/2)**2
+    return EARTH_RADIUS_MILES * 2 * np.arcsin(np.sqrt(a))
+
 def load_stops_data() -> pd.DataFrame:
     """Load stops data from cache or download from CTA website"""
+    global _STOPS_CACHE
     try:
         # Check if we have recent cached data
-        if STOPS_CACHE_FILE.exists():
-            with open(STOPS_CACHE_FILE, 'r') as f:
-                cache_data = json.load(f)
-                cache_timestamp = datetime.fromisoformat(cache_data['timestamp'])
-                if datetime.now() - cache_timestamp < CACHE_DURATION:
-                    df = pd.DataFrame(cache_data['stops'])
-                    # Classify stop types and add parent stop ID for trains
-                    df = classify_stops(df)
-                    return df
-        
+        if STOPS_CACHE_FILE.exists() and STOPS_META_FILE.exists():
+            cache_mtime = STOPS_CACHE_FILE.stat().st_mtime
+            # Already parsed and classified this version of the file,
+            # and the data itself is still fresh
+            if (_STOPS_CACHE is not None and _STOPS_CACHE[0] == cache_mtime
+                    and datetime.now() - _STOPS_CACHE[1] < CACHE_DURATION):
+                return _STOPS_CACHE[2]['df']
+            with open(STOPS_META_FILE, 'r') as f:
+                cache_meta = json.load(f)
+            cache_timestamp = datetime.fromisoformat(cache_meta['timestamp'])
+            if (cache_meta.get('schema_version') == CACHE_SCHEMA_VERSION
+                    and datetime.now() - cache_timestamp < CACHE_DURATION):
+                # Memory-map the Arrow IPC file so multiple uvicorn
+                # workers share one set of read-only pages instead of a
+                # heap copy each; the classified columns were persisted
+                # with the frame, so no reclassification pass is needed
+                source = pa.memory_map(str(STOPS_CACHE_FILE), 'r')
+                table = pa.ipc.open_file(source).read_all()
+                df = table.to_pandas(split_blocks=True)
+                _STOPS_CACHE = (cache_mtime, cache_timestamp, _build_stops_index(df))
+                return df
+
         # If no cache or expired, download fresh data
         url = "https://www.transitchicago.com/downloads/sch_data/CTA_STOP_XFERS.txt"
         headers = [
@@ -44,86 +150,145 @@ def load_stops_data() -> pd.DataFrame:
             'heading_degrees',
             'transfer_to_route_id'  # We'll ignore this column
         ]
-        
-        # Define dtypes for pandas read_csv
-        dtypes = {
-            'route_id': str,
-            'route_code': str,
-            'stop_name': str,
-            'stop_id': int,
-            'stop_lat': float,
-            'stop_lon': float,
-            'heading_degrees': float,
-            'transfer_to_route_id': str  # Keep as string but won't use it
-        }
-        
+
         req = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
         with urllib.request.urlopen(req) as response:
-            data = response.read().decode('utf-8')
-        
-        # Parse the data with specified dtypes
-        df = pd.read_csv(StringIO(data), header=None, dtype=dtypes)
-        df.columns = headers
-        
+            data = response.read()
+
+        # Parse the raw bytes with PyArrow's multi-threaded CSV reader,
+        # keeping only the columns we use; no per-row Python objects
+        table = pacsv.read_csv(
+            BytesIO(data),
+            read_options=pacsv.ReadOptions(column_names=headers),
+            convert_options=pacsv.ConvertOptions(
+                include_columns=list(STOPS_DTYPES),
+                column_types={
+                    'route_id': pa.string(),
+                    'route_code': pa.string(),
+                    'stop_name': pa.string(),
+                    'stop_id': pa.int32(),
+                    'stop_lat': pa.float32(),
+                    'stop_lon': pa.float32(),
+                    'heading_degrees': pa.float32(),
+                }
+            )
+        )
+        df = table.to_pandas(split_blocks=True, self_destruct=True)
+        # Arrow hands back plain strings; finish with the narrow dtypes
+        df = df.astype({
+            'route_id': 'category',
+            'route_code': 'category',
+            'stop_name': 'string',
+        })
+
         # Classify stops and add parent stop ID for trains
         df = classify_stops(df)
         
         # Save to CSV for backup
         df.to_csv(STOPS_DATA_FILE, index=False)
         
-        # Cache the data
-        cache_data = {
-            'timestamp': datetime.now().isoformat(),
-            'stops': df.to_dict('records')
-        }
-        with open(STOPS_CACHE_FILE, 'w') as f:
-            json.dump(cache_data, f)
-        
+        # Cache the data. Uncompressed feather keeps the on-disk layout
+        # identical to the in-memory Arrow buffers, which is what lets
+        # the read path memory-map it instead of decompressing a copy
+        df.to_feather(STOPS_CACHE_FILE, compression='uncompressed')
+        with open(STOPS_META_FILE, 'w') as f:
+            json.dump({
+                'timestamp': datetime.now().isoformat(),
+                'schema_version': CACHE_SCHEMA_VERSION
+            }, f)
+
+        _STOPS_CACHE = (STOPS_CACHE_FILE.stat().st_mtime, datetime.now(), _build_stops_index(df))
         return df
     except Exception as e:
         print(f"Error loading stops data: {str(e)}")
         # If download fails and we have the CSV, use it as fallback
         if STOPS_DATA_FILE.exists():
-            df = pd.read_csv(STOPS_DATA_FILE)
+            df = pd.read_csv(STOPS_DATA_FILE, dtype=STOPS_DTYPES)
             df = classify_stops(df)
             return df
         raise e
 
+# Category labels matching the integer codes _classify_kernel emits
+STOP_TYPE_CATEGORIES = ['bus', 'train', 'parent_train', 'unknown']
+
+if NUMBA_AVAILABLE:
+    # Single-threaded for the same reasons as _haversine_kernel
+    @njit(cache=True)
+    def _classify_kernel(stop_ids, type_out, parent_out):
+        """Derive stop-type codes and parent stop IDs in one linear scan"""
+        for i in range(stop_ids.size):
+            stop_id = stop_ids[i]
+            if stop_id < 30000:
+                type_out[i] = 0  # bus
+                parent_out[i] = stop_id
+            elif stop_id < 40000:
+                type_out[i] = 1  # train
+                parent_out[i] = 40000 + stop_id - 30000
+            elif stop_id < 50000:
+                type_out[i] = 2  # parent_train
+                parent_out[i] = stop_id
+            else:
+                type_out[i] = 3  # unknown
+                parent_out[i] = stop_id
+
 def classify_stops(df: pd.DataFrame) -> pd.DataFrame:
     """Classify stops and add parent stop ID for trains"""
-    # Classify basic stop types
-    df['stop_type'] = df['stop_id'].apply(
-        lambda x: 'bus' if x < 30000 
-        else 'train' if x < 40000 
-        else 'parent_train' if x < 50000 
-        else 'unknown'
-    )
-    
-    # For train stops, calculate parent stop ID (40000 + child stop ID - 30000)
-    df['parent_stop_id'] = df.apply(
-        lambda row: (40000 + (row['stop_id'] - 30000)) if row['stop_type'] == 'train'
-        else row['stop_id'],
-        axis=1
-    )
-    
+    stop_ids = np.ascontiguousarray(df['stop_id'].to_numpy())
+
+    if NUMBA_AVAILABLE:
+        # One fused pass producing int8 codes plus parent IDs
+        type_codes = np.empty(stop_ids.size, dtype=np.int8)
+        parent_stop_id = np.empty_like(stop_ids)
+        _classify_kernel(stop_ids, type_codes, parent_stop_id)
+        df['stop_type'] = pd.Categorical.from_codes(type_codes, STOP_TYPE_CATEGORIES)
+    else:
+        # Vectorized NumPy fallback
+        stop_type = np.select(
+            [stop_ids < 30000, stop_ids < 40000, stop_ids < 50000],
+            ['bus', 'train', 'parent_train'],
+            default='unknown'
+        )
+        df['stop_type'] = pd.Categorical(stop_type, categories=STOP_TYPE_CATEGORIES)
+
+        # For train stops, calculate parent stop ID (40000 + child stop ID - 30000)
+        parent_stop_id = stop_ids.copy()
+        train_mask = stop_type == 'train'
+        parent_stop_id[train_mask] = 40000 + stop_ids[train_mask] - 30000
+
+    df['parent_stop_id'] = parent_stop_id
+
     # Add route information based on route_id and route_code
-    df['route'] = df['route_id']
-    
+    df['route'] = df['route_id'].values
+
     return df
 
 def get_nearby_stops(lat: float, lon: float, radius: float = 0.5) -> Dict[str, List[Dict]]:
     """Get stops within radius miles of the given coordinates, grouped by transit type"""
-    from main import calculate_distance  # Import here to avoid circular import
-    
-    df = load_stops_data()
-    
-    # Calculate distances and filter
-    df['distance'] = df.apply(
-        lambda row: calculate_distance(lat, lon, row['stop_lat'], row['stop_lon']),
-        axis=1
+    index = _get_stops_index()
+    df = index['df']
+
+    # Probe the KDTree for candidate rows. The query radius is inflated
+    # for longitude convergence (and a little slack) so the exact
+    # Haversine filter below never misses a stop inside the radius.
+    query_radius = 1.01 * (radius / EARTH_RADIUS_MILES) / np.cos(np.radians(lat))
+    candidate_idx = np.asarray(
+        index['tree'].query_ball_point([np.radians(lat), np.radians(lon)], r=query_radius),
+        dtype=np.intp
     )
-    
-    nearby_stops = df[df['distance'] <= radius].copy()
+
+    # Calculate exact distances on the candidates and filter
+    distances = haversine_vec(
+        lat, lon,
+        df['stop_lat'].to_numpy()[candidate_idx],
+        df['stop_lon'].to_numpy()[candidate_idx]
+    )
+    within = distances <= radius
+    nearby_idx = candidate_idx[within]
+
+    nearby_stops = df.iloc[nearby_idx].copy()
+    nearby_stops['distance'] = distances[within]
+    is_parent_train = index['is_parent_train'][nearby_idx]
+    is_bus = index['is_bus'][nearby_idx]
     
     # Convert to dictionary format
     def prepare_stop_data(stop, related_stop_ids=None):
@@ -139,35 +304,24 @@ def get_nearby_stops(lat: float, lon: float, radius: float = 0.5) -> Dict[str, L
     
     # Get train stops (use only parent train stops)
     train_stops = [
-        prepare_stop_data(stop) 
-        for _, stop in nearby_stops[nearby_stops['stop_type'] == 'parent_train'].iterrows()
+        prepare_stop_data(stop)
+        for stop in nearby_stops[is_parent_train].sort_values('distance').to_dict('records')
     ]
-    
-    # Consolidate bus stops with the same name and route
-    bus_stops_df = nearby_stops[nearby_stops['stop_type'] == 'bus'].copy()
+
+    # Consolidate bus stops with the same name and route: pairs of stops
+    # (opposite directions) collapse onto the closest one
+    bus_stops_df = nearby_stops[is_bus].sort_values('distance')
+    primary_stops = bus_stops_df.drop_duplicates(['stop_name', 'route'], keep='first')
+    grouped_ids = bus_stops_df.groupby(['stop_name', 'route'], observed=True)['stop_id'].agg(list)
+
     consolidated_bus_stops = []
-    
-    # Group by stop name and route to find pairs of stops (opposite directions)
-    for (name, route), group in bus_stops_df.groupby(['stop_name', 'route']):
-        if len(group) > 0:
-            # Use the stop with minimum distance as the primary stop
-            primary_stop = group.loc[group['distance'].idxmin()]
-            # Get all stop IDs for this name/route combination
-            related_ids = group['stop_id'].tolist()
-            # Remove the primary stop ID from related IDs
-            related_ids.remove(primary_stop['stop_id'])
-            
-            consolidated_stop = primary_stop.copy()
-            consolidated_stop['related_stop_ids'] = related_ids
-            consolidated_bus_stops.append(prepare_stop_data(
-                consolidated_stop,
-                related_stop_ids=related_ids
-            ))
-    
-    # Sort each list by distance
-    train_stops.sort(key=lambda x: x['distance'])
-    consolidated_bus_stops.sort(key=lambda x: x['distance'])
-    
+    for stop in primary_stops.to_dict('records'):
+        related_ids = [
+            stop_id for stop_id in grouped_ids[(stop['stop_name'], stop['route'])]
+            if stop_id != stop['stop_id']
+        ]
+        consolidated_bus_stops.append(prepare_stop_data(stop, related_stop_ids=related_ids))
+
     return {
         'train_stops': train_stops,
         'bus_stops': consolidated_bus_stops
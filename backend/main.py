@@ -1,18 +1,32 @@
-from fastapi import FastAPI, WebSocket, HTTPException
+from fastapi import FastAPI, WebSocket, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 import asyncio
-import json
+import msgpack
+import orjson
+import time
 from typing import List, Optional, Dict
-from pydantic import BaseModel
-import requests
+from pydantic import BaseModel, TypeAdapter
+import httpx
 import xml.etree.ElementTree as ET
 from datetime import datetime
 from config import settings
-import math
-from data_loader import get_nearby_stops
+import numpy as np
+from data_loader import get_nearby_stops, haversine_vec
 from config_handler import save_monitored_stops, load_monitored_stops
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# Shared async HTTP client so all CTA API calls reuse one keep-alive
+# connection pool instead of blocking the event loop per request
+http_client = httpx.AsyncClient(
+    timeout=10.0,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
+)
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await http_client.aclose()
 
 # Enable CORS for development
 origins = [
@@ -51,50 +65,97 @@ class StopsResponse(BaseModel):
     train_stops: List[Stop]
     bus_stops: List[Stop]
 
-def get_train_arrivals(stop_id: int) -> List[Dict]:
+# Pre-compiled validator/serializer: one C-level pass over the whole
+# payload instead of per-Stop __init__ plus a second response_model pass
+STOPS_ADAPTER = TypeAdapter(StopsResponse)
+
+class MsgPackResponse(Response):
+    """Binary response for clients that accept application/x-msgpack"""
+    media_type = "application/x-msgpack"
+
+    def render(self, content) -> bytes:
+        return msgpack.packb(content, use_bin_type=True)
+
+# Map route colors
+ROUTE_COLORS = {
+    "Red": "#c60c30",
+    "Blue": "#00a1de",
+    "Brown": "#62361b",
+    "Green": "#009b3a",
+    "Orange": "#f9461c",
+    "Pink": "#e27ea6",
+    "Purple": "#522398",
+    "Yellow": "#f9e300"
+}
+
+# Short-lived arrivals cache so subscribers polling overlapping stops
+# within the same window share a single upstream CTA call per stop
+ARRIVALS_CACHE_TTL = 15  # seconds
+_arrivals_cache: Dict[tuple, tuple] = {}
+_arrivals_locks: Dict[tuple, asyncio.Lock] = {}
+
+async def _cached_arrivals(cache_key: tuple, fetch) -> List[Dict]:
+    """Return cached arrivals for the key, fetching at most once per TTL"""
+    cached = _arrivals_cache.get(cache_key)
+    if cached and time.monotonic() - cached[0] < ARRIVALS_CACHE_TTL:
+        return cached[1]
+
+    # Single-flight: concurrent callers for the same stop wait on one fetch
+    lock = _arrivals_locks.setdefault(cache_key, asyncio.Lock())
+    async with lock:
+        cached = _arrivals_cache.get(cache_key)
+        if cached and time.monotonic() - cached[0] < ARRIVALS_CACHE_TTL:
+            return cached[1]
+        arrivals = await fetch()
+        _arrivals_cache[cache_key] = (time.monotonic(), arrivals)
+        return arrivals
+
+async def get_train_arrivals(stop_id: int) -> List[Dict]:
+    return await _cached_arrivals(
+        ('train', stop_id),
+        lambda: _fetch_train_arrivals(stop_id)
+    )
+
+async def get_bus_arrivals(stop_id: int, related_stop_ids: List[int] = None) -> List[Dict]:
+    return await _cached_arrivals(
+        ('bus', stop_id, tuple(related_stop_ids or ())),
+        lambda: _fetch_bus_arrivals(stop_id, related_stop_ids)
+    )
+
+async def _fetch_train_arrivals(stop_id: int) -> List[Dict]:
     url = f"http://lapi.transitchicago.com/api/1.0/ttarrivals.aspx"
     params = {
         "key": settings.TRAIN_API_KEY,
         "mapid": stop_id,
         "outputType": "JSON"
     }
-    
+
     try:
-        response = requests.get(url, params=params)
+        response = await http_client.get(url, params=params)
         data = response.json()
         
         arrivals = []
         if "ctatt" in data and "eta" in data["ctatt"]:
+            now = datetime.now()
             for eta in data["ctatt"]["eta"]:
-                arrival_time = datetime.strptime(eta["arrT"], "%Y-%m-%dT%H:%M:%S")
-                minutes = int((arrival_time - datetime.now()).total_seconds() / 60)
-                
-                # Map route colors
-                route_colors = {
-                    "Red": "#c60c30",
-                    "Blue": "#00a1de",
-                    "Brown": "#62361b",
-                    "Green": "#009b3a",
-                    "Orange": "#f9461c",
-                    "Pink": "#e27ea6",
-                    "Purple": "#522398",
-                    "Yellow": "#f9e300"
-                }
-                
+                # arrT is ISO 8601, so take the C fast-path parser
+                arrival_time = datetime.fromisoformat(eta["arrT"])
+                minutes = int((arrival_time - now).total_seconds() / 60)
+
                 arrivals.append({
                     "route": eta["rt"],
                     "destination": eta["destNm"],
                     "arrival_time": eta["arrT"],
                     "minutes": minutes,
                     "is_delayed": eta["isDly"] == "1",
-                    "route_color": route_colors.get(eta["rt"])
+                    "route_color": ROUTE_COLORS.get(eta["rt"])
                 })
         return arrivals
     except Exception as e:
         print(f"Error getting train arrivals: {str(e)}")
         return []
 
-def get_bus_arrivals(stop_id: int, related_stop_ids: List[int] = None) -> List[Dict]:
+async def _fetch_bus_arrivals(stop_id: int, related_stop_ids: List[int] = None) -> List[Dict]:
     """Get bus arrivals for a stop and its related stops (opposite direction)"""
     url = "http://www.ctabustracker.com/bustime/api/v2/getpredictions"
     
@@ -113,15 +174,21 @@ def get_bus_arrivals(stop_id: int, related_stop_ids: List[int] = None) -> List[D
     }
     
     try:
-        response = requests.get(url, params=params)
+        response = await http_client.get(url, params=params)
         data = response.json()
-        
+
         arrivals = []
         if "bustime-response" in data and "prd" in data["bustime-response"]:
+            now = datetime.now()
             for prediction in data["bustime-response"]["prd"]:
-                arrival_time = datetime.strptime(prediction["prdtm"], "%Y%m%d %H:%M")
-                minutes = int((arrival_time - datetime.now()).total_seconds() / 60)
-                
+                # prdtm is "YYYYMMDD HH:MM"; direct slicing beats strptime
+                prdtm = prediction["prdtm"]
+                arrival_time = datetime(
+                    int(prdtm[:4]), int(prdtm[4:6]), int(prdtm[6:8]),
+                    int(prdtm[9:11]), int(prdtm[12:14])
+                )
+                minutes = int((arrival_time - now).total_seconds() / 60)
+
                 arrivals.append({
                     "route": prediction["rt"],
                     "destination": prediction["des"],
@@ -140,25 +207,22 @@ def get_bus_arrivals(stop_id: int, related_stop_ids: List[int] = None) -> List[D
 
 def calculate_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     """Calculate distance between two points in miles using Haversine formula"""
-    R = 3959.87433  # Earth's radius in miles
-
-    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-
-    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-    c = 2 * math.asin(math.sqrt(a))
-    return R * c
+    return float(haversine_vec(lat1, lon1, np.asarray([lat2]), np.asarray([lon2]))[0])
 
+# response_model documents the schema in OpenAPI; it costs nothing at
+# runtime because the handler returns Response instances, which FastAPI
+# passes through without a second serialization pass
 @app.get("/api/stops", response_model=StopsResponse)
-async def get_stops(lat: float, lon: float, radius: float = 0.5) -> Dict[str, List[Stop]]:
+async def get_stops(request: Request, lat: float, lon: float, radius: float = 0.5):
     """Get stops within radius miles of the given coordinates"""
     try:
         stops_data = get_nearby_stops(lat, lon, radius)
-        return {
-            'train_stops': [Stop(**stop) for stop in stops_data['train_stops']],
-            'bus_stops': [Stop(**stop) for stop in stops_data['bus_stops']]
-        }
+        validated = STOPS_ADAPTER.validate_python(stops_data)
+        # Content negotiation: msgpack halves payload size for clients
+        # that ask for it; everyone else gets JSON straight from the adapter
+        if "application/x-msgpack" in request.headers.get("accept", ""):
+            return MsgPackResponse(STOPS_ADAPTER.dump_python(validated, mode='json'))
+        return Response(content=STOPS_ADAPTER.dump_json(validated), media_type="application/json")
     except Exception as e:
         print(f"Error in get_stops: {str(e)}")
         import traceback
@@ -188,37 +252,101 @@ async def get_arrivals(stop_id: int, related_stop_ids: str = None):
     """Get arrivals for a specific stop and its related stops"""
     try:
         # Convert related_stop_ids from string to list if provided
-        related_ids = json.loads(related_stop_ids) if related_stop_ids else None
+        related_ids = orjson.loads(related_stop_ids) if related_stop_ids else None
         
         # Try train arrivals first
         if stop_id >= 40000:  # Train stop IDs are 40000+
-            arrivals = get_train_arrivals(stop_id)
+            arrivals = await get_train_arrivals(stop_id)
         else:  # Bus stop
-            arrivals = get_bus_arrivals(stop_id, related_ids)
+            arrivals = await get_bus_arrivals(stop_id, related_ids)
         return arrivals
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# Shared broadcaster: one background poll per interval covers every
+# connected client, so K subscribers watching the same stop cost one
+# round of upstream fetches instead of K
+_ws_subscribers: Dict[WebSocket, List[int]] = {}
+_ws_wakeup = asyncio.Event()
+_broadcast_task: Optional[asyncio.Task] = None
+
+async def _broadcast_arrivals():
+    while True:
+        # Clear before snapshotting so a subscription that arrives while
+        # this round is in flight wakes the next round immediately
+        _ws_wakeup.clear()
+        try:
+            subscriptions = dict(_ws_subscribers)
+            unique_stops = list({stop_id for stop_ids in subscriptions.values() for stop_id in stop_ids})
+
+            # Fetch each unique stop once, capped so a large union of watch
+            # lists can't flood the CTA API. Call the getters directly; the
+            # HTTP handler would wrap failures in HTTPException
+            semaphore = asyncio.Semaphore(settings.MAX_CONCURRENT_STOPS)
+
+            async def fetch_arrivals(stop_id):
+                async with semaphore:
+                    if stop_id >= 40000:  # Train stop IDs are 40000+
+                        return await get_train_arrivals(stop_id)
+                    return await get_bus_arrivals(stop_id)
+
+            results = await asyncio.gather(
+                *[fetch_arrivals(stop_id) for stop_id in unique_stops],
+                return_exceptions=True
+            )
+            all_arrivals = {}
+            for stop_id, result in zip(unique_stops, results):
+                if isinstance(result, Exception):
+                    print(f"Error fetching arrivals for stop {stop_id}: {result}")
+                    result = []
+                all_arrivals[stop_id] = result
+
+            # Fan the shared snapshot out to each subscriber's stop list
+            for websocket, stop_ids in subscriptions.items():
+                try:
+                    await websocket.send_json({stop_id: all_arrivals.get(stop_id, []) for stop_id in stop_ids})
+                except Exception:
+                    _ws_subscribers.pop(websocket, None)
+        except Exception as e:
+            # The broadcaster must outlive any single bad round: log and
+            # keep polling for the clients that are still connected
+            print(f"Broadcast error: {e}")
+
+        # Sleep until the next interval, or earlier if a subscription
+        # change needs a fresh snapshot pushed promptly
+        try:
+            await asyncio.wait_for(_ws_wakeup.wait(), timeout=settings.UPDATE_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+@app.on_event("startup")
+async def start_broadcaster():
+    global _broadcast_task
+    _broadcast_task = asyncio.create_task(_broadcast_arrivals())
+
+@app.on_event("shutdown")
+async def stop_broadcaster():
+    if _broadcast_task:
+        _broadcast_task.cancel()
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     try:
         while True:
-            # Receive stop IDs to monitor
+            # Receive stop IDs to monitor; the broadcaster task handles
+            # fetching and pushing updates
             stops = await websocket.receive_json()
-            
-            # Get arrivals for all stops
-            all_arrivals = {}
-            for stop_id in stops:
-                arrivals = await get_arrivals(stop_id)
-                all_arrivals[stop_id] = arrivals
-                
-            # Send updates
-            await websocket.send_json(all_arrivals)
-            
-            # Wait for the update interval
-            await asyncio.sleep(settings.UPDATE_INTERVAL)
+            try:
+                stop_ids = [int(stop_id) for stop_id in stops]
+            except (TypeError, ValueError):
+                # Bad input stays this client's problem; it must never
+                # reach the shared broadcaster
+                continue
+            _ws_subscribers[websocket] = stop_ids
+            _ws_wakeup.set()
     except Exception as e:
         print(f"WebSocket error: {e}")
     finally:
+        _ws_subscribers.pop(websocket, None)
         await websocket.close() 
\ No newline at end of file